@@ -1,4 +1,5 @@
 from qiskit.circuit import QuantumCircuit, QuantumRegister, AncillaRegister, ClassicalRegister
+from qiskit.circuit.classical import expr
 from qiskit.circuit.library import StatePreparation
 import numpy as np
 
@@ -7,6 +8,8 @@ import numpy as np
 # Description:
 #	Provides Qiskit circuit components for encoding physical qubits and remedying
 #	errors under the 9-qubit Shor code.
+#	Each component is built on its first request and cached on the instance, so
+#	returned gates and circuits are shared and should not be modified in place.
 #
 # Inputs:
 #	<none>
@@ -24,6 +27,7 @@ import numpy as np
 #
 # Requirements:
 #	QuantumCircuit, QuantumRegister, AncillaRegister, ClassicalRegister from qiskit.circuit
+#	expr from qiskit.circuit.classical
 # 	StatePreparation from qiskit.circuit.library
 #	numpy as np
 
@@ -36,24 +40,35 @@ class Shor_QECC:
 		self.__qubits_code = QuantumRegister(size=9, name='code')
 		self.__qubits_checks = AncillaRegister(size=8, name='check')
 		self.__syndromes = ClassicalRegister(8, name='syndromes')
+		self.__cache = {} # built components, keyed by getter name
 		
 	def get_logical_0_preparer(self):
+		if 'logical_0_preparer' in self.__cache:
+			return self.__cache['logical_0_preparer']
+
 		preparer_qc = QuantumCircuit(self.__qubits_code, name='Shor Logical 0\nPreparation')
-		preparer_qc.cx(self.__qubits_code[0],self.__qubits_code[3])
-		preparer_qc.cx(self.__qubits_code[0],self.__qubits_code[6])
+		preparer_qc.cx(self.__qubits_code[0],self.__qubits_code[[3,6]])
 		preparer_qc.h(self.__qubits_code[[0,3,6]])
-		for i in range(3):
-			preparer_qc.cx(self.__qubits_code[3*i], self.__qubits_code[3*i + 1])
-			preparer_qc.cx(self.__qubits_code[3*i], self.__qubits_code[3*i + 2])
+		# spread the first qubit of each block to the rest of its block
+		preparer_qc.cx(self.__qubits_code[[0,3,6]], self.__qubits_code[[1,4,7]])
+		preparer_qc.cx(self.__qubits_code[[0,3,6]], self.__qubits_code[[2,5,8]])
 			
-		return preparer_qc.to_gate()
+		self.__cache['logical_0_preparer'] = preparer_qc.to_gate()
+		return self.__cache['logical_0_preparer']
 		
 	def get_logical_X(self):
+		if 'logical_X' in self.__cache:
+			return self.__cache['logical_X']
+
 		logical_X_qc = QuantumCircuit(self.__qubits_code, name='Shor Logical X')
 		logical_X_qc.z(self.__qubits_code[:])
-		return logical_X_qc.to_gate()
+		self.__cache['logical_X'] = logical_X_qc.to_gate()
+		return self.__cache['logical_X']
 		
 	def __get_error_checker(self):
+		if 'error_checker' in self.__cache:
+			return self.__cache['error_checker']
+
 		checker_qc = QuantumCircuit(
 			self.__qubits_code, self.__qubits_checks,
 			name='Shor Error Checker'
@@ -61,21 +76,28 @@ class Shor_QECC:
 		
 		# X checks
 		for i in range(3):
-			checker_qc.cx(self.__qubits_code[3*i], self.__qubits_checks[2*i])
-			checker_qc.cx(self.__qubits_code[3*i+1], self.__qubits_checks[2*i])
-			checker_qc.cx(self.__qubits_code[3*i+1], self.__qubits_checks[2*i+1])
-			checker_qc.cx(self.__qubits_code[3*i+2], self.__qubits_checks[2*i+1])
+			checker_qc.cx(self.__qubits_code[[3*i, 3*i+1]], self.__qubits_checks[2*i])
+			checker_qc.cx(self.__qubits_code[[3*i+1, 3*i+2]], self.__qubits_checks[2*i+1])
 		
-		# Z checks
+		# Z checks (each compares the X parities of two neighboring blocks, using the same
+		# H-CX-H pattern on a check qubit, so the pattern is built once as a gate)
+		z_check_qc = QuantumCircuit(7, name='Shor Z Check')
+		z_check_qc.h(0)
+		z_check_qc.cx([0]*6, range(1,7))
+		z_check_qc.h(0)
+		z_check = z_check_qc.to_gate()
 		for i in range(2):
-			checker_qc.h(self.__qubits_checks[i+6])
-			for j in range(6):
-				checker_qc.cx(self.__qubits_checks[i+6], self.__qubits_code[3*i+j])
-			checker_qc.h(self.__qubits_checks[i+6])
+			checker_qc.append(
+				z_check, [self.__qubits_checks[i+6], *self.__qubits_code[3*i:3*i+6]]
+			)
     
-		return checker_qc.to_gate()
+		self.__cache['error_checker'] = checker_qc.to_gate()
+		return self.__cache['error_checker']
 	
 	def get_error_corrector(self):
+		if 'error_corrector' in self.__cache:
+			return self.__cache['error_corrector']
+
 		corrector_qc = QuantumCircuit(
 			self.__qubits_code, self.__qubits_checks, self.__syndromes,
 			name='Shor Corrector'
@@ -87,27 +109,28 @@ class Shor_QECC:
 		corrector_qc.measure(self.__qubits_checks, self.__syndromes)
 		corrector_qc.barrier()
 		
-		# correct Z errors
-		with corrector_qc.if_test((self.__syndromes[6],1)):
-			with corrector_qc.if_test((self.__syndromes[7],0)):
-				corrector_qc.z(self.__qubits_code[0:3])
-		with corrector_qc.if_test((self.__syndromes[6],1)):
-			with corrector_qc.if_test((self.__syndromes[7],1)):
-				corrector_qc.z(self.__qubits_code[3:6])
-		with corrector_qc.if_test((self.__syndromes[6],0)):
-			with corrector_qc.if_test((self.__syndromes[7],1)):
-				corrector_qc.z(self.__qubits_code[6:9])
+		# correct Z errors, with the value of syndrome pair 3 picking which block to remedy
+		for value, j in [(0b01, 0), (0b11, 1), (0b10, 2)]:
+			with corrector_qc.if_test(self.__get_syndrome_pair_condition(3, value)):
+				corrector_qc.z(self.__qubits_code[3*j:3*j+3])
 			
-		# correct X errors
+		# correct X errors, with the value of syndrome pair i picking which qubit of block i
+		# to remedy
 		for i in range(3):
-			with corrector_qc.if_test((self.__syndromes[2*i],1)):
-				with corrector_qc.if_test((self.__syndromes[2*i+1],0)):
-					corrector_qc.x(self.__qubits_code[3*i])
-			with corrector_qc.if_test((self.__syndromes[2*i],1)):
-				with corrector_qc.if_test((self.__syndromes[2*i+1],1)):
-					corrector_qc.x(self.__qubits_code[3*i+1])
-			with corrector_qc.if_test((self.__syndromes[2*i],0)):
-				with corrector_qc.if_test((self.__syndromes[2*i+1],1)):
-					corrector_qc.x(self.__qubits_code[3*i+2])
+			for value, j in [(0b01, 0), (0b11, 1), (0b10, 2)]:
+				with corrector_qc.if_test(self.__get_syndrome_pair_condition(i, value)):
+					corrector_qc.x(self.__qubits_code[3*i+j])
 				
+		self.__cache['error_corrector'] = corrector_qc
 		return corrector_qc
+	
+	def __get_syndrome_pair_condition(self, i, value):
+		# condition that syndrome pair i (syndromes 2i and 2i+1, read with the lower syndrome
+		# as the low bit) has the given value. Pairs 0-2 check for X errors in each block of
+		# three code qubits, and pair 3 checks for Z errors. The condition is an expression on
+		# the syndrome bits themselves, so the corrector needs no extra registers
+		conditions = [
+			bit if (value >> j) & 1 else expr.logic_not(bit)
+			for j, bit in enumerate(self.__syndromes[2*i:2*i+2])
+		]
+		return expr.logic_and(*conditions)
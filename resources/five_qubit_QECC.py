@@ -1,5 +1,4 @@
 from qiskit.circuit import QuantumCircuit, QuantumRegister, AncillaRegister, ClassicalRegister
-from qiskit.circuit.library import StatePreparation
 import numpy as np
 
 # 5-Qubit Quantum Error Correcting Code Class
@@ -7,6 +6,8 @@ import numpy as np
 # Description:
 #	Provides Qiskit circuit components for encoding physical qubits and remedying
 #	errors under the 5-qubit code.
+#	Each component is built on its first request and cached on the instance, so
+#	returned gates and circuits are shared and should not be modified in place.
 #
 # Inputs:
 #	<none>
@@ -21,43 +22,81 @@ import numpy as np
 #		logical X for this code. 
 #	get_error_corrector - Returns a circuit that acts on the physical qubits, the syndrome
 #		ancilla qubits, and the syndrome classical bits to check and correct for errors.
-#	get_logical_0_components - Returns a list of bit strings that correspond to the
+#	get_logical_0_components - Returns a tuple of bit strings that correspond to the
 #		elements of the computational basis that appear in the logical 0
 #		state.
 #
 # Requirements:
 #	QuantumCircuit, QuantumRegister, AncillaRegister, ClassicalRegister from qiskit.circuit
-# 	StatePreparation from qiskit.circuit.library
 #	numpy as np
 
 class Five_Qubit_QECC:
 
 	num_physical_qubits = 5
 	num_syndromes = 4
-	__logical0_coef_pos = ['00000','00101','01010','10100','01001','10010']
-	__logical0_coef_neg = [
-		'00011','00110','01100','11000','10001','01111','11110','11101','11011','10111'
-	]
+	# computational basis elements in the logical 0 state, by sign of their coefficient
+	__logical0_coef_pos = np.array([0b00000,0b00101,0b01010,0b10100,0b01001,0b10010])
+	__logical0_coef_neg = np.array([
+		0b00011,0b00110,0b01100,0b11000,0b10001,0b01111,0b11110,0b11101,0b11011,0b10111
+	])
+	__logical0_component_indices = np.concatenate((__logical0_coef_pos, __logical0_coef_neg))
+	__logical0_components = tuple(format(c, '05b') for c in __logical0_component_indices)
 	
 	def __init__(self):
 		self.__qubits_code = QuantumRegister(size=5, name='code')
 		self.__qubits_checks = AncillaRegister(size=4, name='check')
 		self.__syndromes = ClassicalRegister(4, name='syndromes')
+		self.__cache = {} # built components, keyed by getter name
+		
+		# the remedy for each (non-zero) syndrome integer: the Pauli to apply and the code
+		# qubit to apply it to, undoing the weight-1 error with that syndrome
+		self.__remedies = {}
+		for j in range(5): # X error on qubit j
+			syndromes_int = 2**((j-1)%5) + 2**((j-2)%5)  # integer for syndrome bit string
+			syndromes_int = syndromes_int % (2**4) # drop most significant bit
+			self.__remedies[syndromes_int] = ('X', j)
+		for j in range(5): # Z error on qubit j
+			syndromes_int = 2**(j%5) + 2**((j-3)%5)
+			syndromes_int = syndromes_int % (2**4)
+			self.__remedies[syndromes_int] = ('Z', j)
+		for j in range(5): # Y error on qubit j
+			syndromes_int = 31 - 2**((j-4)%5)
+			syndromes_int = syndromes_int % (2**4)
+			self.__remedies[syndromes_int] = ('Y', j)
 		
 	def get_logical_0_preparer(self):
-		logical0_coefficients = np.zeros((2**5))
-		logical0_coefficients[[int(c,2) for c in self.__logical0_coef_pos]] = 1/4
-		logical0_coefficients[[int(c,2) for c in self.__logical0_coef_neg]] = -1/4
-		return StatePreparation(
-			logical0_coefficients, normalize=True, label='5-Qubit Logical 0\nPreparation'
-		)
+		if 'logical_0_preparer' in self.__cache:
+			return self.__cache['logical_0_preparer']
+
+		# the components of the logical 0 state are exactly the even-weight bit strings, and
+		# a component's coefficient is -1 when it has an odd number of pairs of cyclically
+		# neighboring 1s (and +1 otherwise)
+		preparer_qc = QuantumCircuit(self.__qubits_code, name='5-Qubit Logical 0\nPreparation')
+		
+		# superpose the even-weight bit strings (qubit 4 takes the parity of the rest)
+		preparer_qc.h(self.__qubits_code[0:4])
+		preparer_qc.cx(self.__qubits_code[0:4], self.__qubits_code[4])
+		
+		# phase of -1 for each pair of neighboring 1s
+		for i in range(5):
+			preparer_qc.cz(self.__qubits_code[i], self.__qubits_code[(i+1)%5])
+			
+		self.__cache['logical_0_preparer'] = preparer_qc.to_gate()
+		return self.__cache['logical_0_preparer']
 		
 	def get_logical_X(self):
+		if 'logical_X' in self.__cache:
+			return self.__cache['logical_X']
+
 		logical_X_qc = QuantumCircuit(self.__qubits_code, name='5-Qubit Logical X')
 		logical_X_qc.x(self.__qubits_code[:])
-		return logical_X_qc.to_gate()
+		self.__cache['logical_X'] = logical_X_qc.to_gate()
+		return self.__cache['logical_X']
 		
 	def __get_error_checker(self):
+		if 'error_checker' in self.__cache:
+			return self.__cache['error_checker']
+
 		checker_qc = QuantumCircuit(
 			self.__qubits_code, self.__qubits_checks,
 			name='5-Qubit Error Checker'
@@ -72,9 +111,13 @@ class Five_Qubit_QECC:
 			checker_qc.cx(self.__qubits_checks[i], self.__qubits_code[(i+3)%5])
 		checker_qc.h(self.__qubits_checks[:])
 		
-		return checker_qc.to_gate()
+		self.__cache['error_checker'] = checker_qc.to_gate()
+		return self.__cache['error_checker']
 	
 	def get_error_corrector(self):
+		if 'error_corrector' in self.__cache:
+			return self.__cache['error_corrector']
+
 		corrector_qc = QuantumCircuit(
 			self.__qubits_code, self.__qubits_checks, self.__syndromes,
 			name='5-Qubit Corrector'
@@ -86,29 +129,15 @@ class Five_Qubit_QECC:
 		corrector_qc.measure(self.__qubits_checks, self.__syndromes)
 		corrector_qc.barrier()
 		
-		# correct X errors
-		for j in range(5): # ... on qubit j
-			syndromes_int = 2**((j-1)%5) + 2**((j-2)%5)  # integer for syndrome bit string
-			syndromes_int = syndromes_int % (2**4) # drop most significant bit
-			with corrector_qc.if_test((self.__syndromes, syndromes_int)):
-				corrector_qc.x(self.__qubits_code[j])
-		
-		# correct Z errors
-		for j in range(5):
-			syndromes_int = 2**(j%5) + 2**((j-3)%5)
-			syndromes_int = syndromes_int % (2**4)
-			with corrector_qc.if_test((self.__syndromes, syndromes_int)):
-				corrector_qc.z(self.__qubits_code[j])
-				
-		# correct Y errors
-		for j in range(5):
-			syndromes_int = 31 - 2**((j-4)%5)
-			syndromes_int = syndromes_int % (2**4)
-			with corrector_qc.if_test((self.__syndromes, syndromes_int)):
-				corrector_qc.y(self.__qubits_code[j])
+		# correct errors, with a single switch on the syndrome integer
+		with corrector_qc.switch(self.__syndromes) as case:
+			for syndromes_int, (pauli, j) in self.__remedies.items():
+				with case(syndromes_int):
+					corrector_qc.pauli(pauli, [self.__qubits_code[j]])
 				
+		self.__cache['error_corrector'] = corrector_qc
 		return corrector_qc
 	
 	def get_logical_0_components(self):
-		return self.__logical0_coef_pos + self.__logical0_coef_neg
+		return self.__logical0_components
 		
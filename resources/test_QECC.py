@@ -1,7 +1,13 @@
 from .five_qubit_QECC import *
+from functools import lru_cache
 from qiskit_aer import AerSimulator
 from qiskit_aer.noise import NoiseModel, pauli_error
-from qiskit import transpile
+from qiskit.transpiler import PassManager
+from qiskit.transpiler.passes import HighLevelSynthesis
+from qiskit.circuit import Clbit, ClassicalRegister, CASE_DEFAULT
+from qiskit.circuit.classical import expr, types
+from qiskit.circuit.library import IGate
+from qiskit.quantum_info import Clifford, Pauli, Statevector
 
 # Test Quantum Error Correcting Code Under Random Pauli Errors
 #
@@ -20,10 +26,15 @@ from qiskit import transpile
 #		- under option A, measurements which resulted in a component of the desired
 #			logical state. Note: this is valid only for some codes, like the 5-qubit code.
 #		- under option B, measurements of all 0s.
+#	Alternatively, it can skip the repeated trials and compute the exact probability of a
+#	successful measurement, by summing over every possible pattern of Pauli errors. Each
+#	pattern is tracked through the circuit as a Pauli frame (instead of simulating the
+#	state), which requires the ECC's components to be Clifford and its corrections to be
+#	Pauli gates, but is practical even for larger codes, like Shor's code.
 #
 # Inputs:
-#	p - probability of each non-trivial Pauli gate. May be a list of values, in which
-#		case, the test is repeated for each value.
+#	p - probability of each non-trivial Pauli gate, between 0 and 1/3. May be a sequence
+#		(e.g. a list or array) of values, in which case, the test is repeated for each value.
 #	logical_state (optional, default = 0)
 #	trails (optional, default = 1000) - the number of trails over which to repeat the
 #		procedure 
@@ -32,99 +43,419 @@ from qiskit import transpile
 #		select between tests A and B, respectively.
 #	error_locations (optional, default = "all") - either "all" or a list of non-negative
 #		integers, the indicies of the code qubits that are subject to the random error 
+#	simulation_type (optional, default = "sampled") - either "sampled" or "exact" to
+#		select between repeated trials and the exact probability of success. The number of
+#		trials is ignored for "exact".
 #
 # Outputs:
-#	frac_succesful - the the fraction of trials in which the test was succesful. A list if
-#		p is a list.
+#	frac_succesful - the the fraction of trials in which the test was succesful (or the
+#		probability of success, if exact). An array if p is a sequence.
 #
 # Requirements:
 #	AerSimulator from qiskit_aer
-#	NoiseModel, pauli_error from qiskit_aer.noise
-#	transpile from qiskit
+#	NoiseModel from qiskit_aer.noise
+#	PassManager from qiskit.transpiler
+#	HighLevelSynthesis from qiskit.transpiler.passes
+#	IGate from qiskit.circuit.library
+#	Statevector from qiskit.quantum_info
+#	numpy as np
 # 	Five_Qubit_ECC from .five_qubit_ECC
+#	_random_Pauli_error
+#	_propagate_Pauli_frames
 
 def test_QECC_random_Pauli_errors(
 	p, logical_state=0, trials=1000, ecc=Five_Qubit_QECC(), measurement_type='logical',
-	error_locations='all'
+	error_locations='all', simulation_type='sampled'
 ):
 
+	if simulation_type not in ['sampled', 'exact']:
+		raise ValueError(
+			"simulation_type must be 'sampled' or 'exact', not " + repr(simulation_type)
+		)
+
+	# accept a single value or any sequence of values (list, tuple, array, ...)
+	pList = np.atleast_1d(p).astype(float)
+	fracCorrectList = np.empty(pList.size)
+	if pList.size == 0:
+		return fracCorrectList
+
+	# each non-trivial Pauli gate has probability p, so p must be in [0, 1/3]
+	if np.any((pList < 0) | (pList > 1/3)):
+		raise ValueError('every value of p must be between 0 and 1/3')
+
+	if error_locations == 'all':
+		error_locations = list(range(ecc.num_physical_qubits))
+
 	# build circuit using components from the ECC class
 	qubits_code = QuantumRegister(size=ecc.num_physical_qubits, name='code')
 	qubits_check = AncillaRegister(size=ecc.num_syndromes, name='check')
 	syndromes = ClassicalRegister(size=ecc.num_syndromes, name='syndromes')
 	clbits_code = ClassicalRegister(size=ecc.num_physical_qubits, name='code_measurements')
 
-	qecc_qc = QuantumCircuit(qubits_code, qubits_check, syndromes, clbits_code)
-	qecc_qc.compose(ecc.get_logical_0_preparer(), inplace=True)
+	logical_0_preparer = ecc.get_logical_0_preparer()
+	logical_X = ecc.get_logical_X()
+
+	qecc_qc = QuantumCircuit(qubits_code, qubits_check, syndromes)
+	qecc_qc.compose(logical_0_preparer, inplace=True)
 
 	# flip to logical 1 state, if desired
 	if logical_state == 1:
-		qecc_qc.compose(ecc.get_logical_X(), inplace=True)
+		qecc_qc.compose(logical_X, inplace=True)
 
 	# introduce identity gates, which will be made noisy
-	if error_locations == 'all':
-		qecc_qc.id(qubits_code[:])
-	else:
-		qecc_qc.id(qubits_code[error_locations])
-
-	# add error corrector
-	qecc_qc.compose(ecc.get_error_corrector(), inplace=True)
+	qecc_qc.id(qubits_code[error_locations])
 
-	# add measurement of physical qubits, undoing encoding first if desired
+	# add error corrector, and undo encoding if desired. These are all that act after the
+	# errors, so they are also kept as a circuit of their own
+	correction_qc = QuantumCircuit(qubits_code, qubits_check, syndromes)
+	correction_qc.compose(ecc.get_error_corrector(), inplace=True)
 	if measurement_type=='decoded':
 		if logical_state == 1:
-			qecc_qc.compose(ecc.get_logical_X(), inplace=True)
-		qecc_qc.compose(ecc.get_logical_0_preparer().inverse(), inplace=True)
+			correction_qc.compose(logical_X, inplace=True)
+		correction_qc.compose(logical_0_preparer.inverse(), inplace=True)
+	qecc_qc.compose(correction_qc, inplace=True)
+
+	# add measurement of physical qubits
+	# note: the register for these measurements is added last (after any registers the
+	# ECC components bring in), so that it is the leading bit string in the counts
+	qecc_qc.add_register(clbits_code)
 	qecc_qc.measure(qubits_code, clbits_code)
-	
-	# simulate circuit with noise for each value of p and store results
-	
-	if type(p) is list:
-		pList = p
-	else:
-		pList = [p]
-		
-	fracCorrectList = []
 
-	for prob in pList:
-		# add noise to the identity gates
-		noise_model = NoiseModel()
-		noise_model.add_all_qubit_quantum_error(
-			pauli_error([('X',prob), ('Y',prob), ('Z',prob), ('I', 1 - 3*prob)]), 
-			['id']
+	if measurement_type != 'decoded':
+		logical0_components = np.array(
+			[int(c,2) for c in ecc.get_logical_0_components()], dtype=np.int64
 		)
-	
-		# set up and run simulator
-		simulator = AerSimulator(noise_model=noise_model)
-		compiled_circuit = transpile(qecc_qc, simulator, optimization_level=0)
-		job = simulator.run(compiled_circuit, shots=trials)
 
-		# get measurement counts
-		counts = job.result().get_counts()
+	if simulation_type == 'exact':
+		# list every pattern of errors, as the Pauli (0 = I, 1 = X, 2 = Y, 3 = Z) at each
+		# error location, and track each through the circuit after the errors
+		num_errors = len(error_locations)
+		patterns = (np.arange(4**num_errors)[:,None] // 4**np.arange(num_errors)) % 4
+		frames = np.zeros((len(patterns), 2*correction_qc.num_qubits), dtype=np.uint8)
+		for j, location in enumerate(error_locations):
+			# combine the X and Z parts of each error with those of any earlier error at the
+			# same location
+			frames[:, location] ^= (patterns[:, j] == 1) | (patterns[:, j] == 2)
+			frames[:, correction_qc.num_qubits + location] ^= patterns[:, j] >= 2
+		frames = _propagate_Pauli_frames(correction_qc, frames)
+
+		# the X part of each final frame flips the measurement of the physical qubits,
+		# compared with the measurement without errors
+		num_physical_qubits = ecc.num_physical_qubits
+		flips = frames[:, :num_physical_qubits] @ (1 << np.arange(num_physical_qubits))
 
 		if measurement_type=='decoded':
-			# in this case, find the number of trials where the measurement was all 0's
-			count_correct = 0
-			for state in counts:
-				if state[:ecc.num_physical_qubits] == '0'*ecc.num_physical_qubits:
-					count_correct += counts[state]
-			fracCorrectList.append(count_correct/trials)
+			# in this case, success is when the measurement is still all 0's
+			pattern_success = (flips == 0).astype(float)
 		else:
-			# find number of trials where the measurement is a component of the correct
-			# logical state. Warning: this assumes that the components of the logical 0 
-			# and logical 1 are disjoint! This is a useful statistic for the 5-qubit code,
-			# but not many other codes!
-			count_correct = [0,0]
-			for state in counts:
-				if state[:ecc.num_physical_qubits] in ecc.get_logical_0_components():
-					count_correct[0] += counts[state]
-				else:
-					count_correct[1] += counts[state]
-			fracCorrectList.append(count_correct[logical_state]/trials)
-		
-	if type(p) is list:
-		return fracCorrectList
+			# otherwise, success is when the measurement is still a component of the
+			# correct logical state. Without errors, each measurement outcome occurs with
+			# the probability it has in the logical state. (See the warning below.)
+			logical_state_vector = Statevector(logical_0_preparer)
+			if logical_state == 1:
+				logical_state_vector = logical_state_vector.evolve(logical_X)
+			outcome_probabilities = logical_state_vector.probabilities()
+			outcomes = np.arange(len(outcome_probabilities))
+			is_correct = np.isin(outcomes, logical0_components) == (logical_state == 0)
+			flip_success = np.array(
+				[outcome_probabilities @ is_correct[outcomes ^ flip] for flip in outcomes]
+			)
+			pattern_success = flip_success[flips]
+
+		# total the successes by the number of errors in each pattern, then weight each
+		# pattern by its probability, p^(# errors) * (1-3p)^(# no errors)
+		num_nontrivial = (patterns != 0).sum(axis=1)
+		success_by_num = np.bincount(
+			num_nontrivial, weights=pattern_success, minlength=num_errors+1
+		)
+		nums = np.arange(num_errors+1)
+		fracCorrectList[:] = (
+			pList[:,None]**nums * (1 - 3*pList[:,None])**(num_errors - nums)
+		) @ success_by_num
+
 	else:
-		return fracCorrectList[0]
-		
-		
+		# add noise to the identity gates: each value of p gets its own label for the
+		# identity gates, and a single noise model holds the error for every label
+		noise_model = NoiseModel()
+		error_labels = []
+		for i, prob in enumerate(pList):
+			error_labels.append('pauli_error_' + str(i))
+			noise_model.add_all_qubit_quantum_error(
+				_random_Pauli_error(float(prob)), [error_labels[i]]
+			)
+
+		# the circuit is the same for every value of p, so compile it only once. No layout
+		# or optimization is needed for the simulator, only unrolling of the ECC's custom
+		# gates into gates that Aer supports (which also leaves the identity gates in place)
+		compiled_circuit = PassManager([HighLevelSynthesis(basis_gates=[
+			'u', 'cx', 'cz', 'swap', 'h', 's', 'sdg', 'x', 'y', 'z', 'id', 'measure',
+			'barrier', 'if_else', 'switch_case'
+		])]).run(qecc_qc)
+
+		# make a copy of the compiled circuit for each value of p, with the matching label
+		# on its identity gates
+		circuits = []
+		for label in error_labels:
+			circuit = compiled_circuit.copy()
+			for i, instruction in enumerate(circuit.data):
+				if instruction.operation.name == 'id':
+					circuit.data[i] = instruction.replace(operation=IGate(label=label))
+			circuits.append(circuit)
+
+		# run all circuits as a single job on one simulator, in which Aer may run the
+		# circuits in parallel (up to its maximum number of threads, with
+		# max_parallel_experiments=0)
+		simulator = AerSimulator()
+		result = simulator.run(
+			circuits, shots=trials, noise_model=noise_model, max_parallel_experiments=0
+		).result()
+
+		# note: the physical qubits are measured into the last clbits, which are the most
+		# significant bits of the integer form of each measurement outcome
+		measurement_shift = qecc_qc.num_clbits - ecc.num_physical_qubits
+
+		for i in range(len(pList)):
+			# get measurement counts, keyed by the hexadecimal form of each outcome
+			counts = result.data(i)['counts']
+
+			# split counts into arrays of measurements of the physical qubits and their counts
+			measurements = np.fromiter(
+				(int(state,16) for state in counts), dtype=np.int64, count=len(counts)
+			) >> measurement_shift
+			frequencies = np.fromiter(counts.values(), dtype=np.int64, count=len(counts))
+
+			if measurement_type=='decoded':
+				# in this case, find the number of trials where the measurement was all 0's
+				count_correct = int(frequencies[measurements == 0].sum())
+				fracCorrectList[i] = count_correct/trials
+			else:
+				# find number of trials where the measurement is a component of the correct
+				# logical state. Warning: this assumes that the components of the logical 0 
+				# and logical 1 are disjoint! This is a useful statistic for the 5-qubit code,
+				# but not many other codes!
+				is_logical0 = np.isin(measurements, logical0_components)
+				count_correct = [
+					int(frequencies[is_logical0].sum()), int(frequencies[~is_logical0].sum())
+				]
+				fracCorrectList[i] = count_correct[logical_state]/trials
+
+	if np.ndim(p) == 0:
+		return float(fracCorrectList[0])
+	else:
+		return fracCorrectList
+
+
+# Random Pauli Error
+#
+# Description:
+#	Returns the noise channel that applies X, Y, or Z, each with probability p, and I
+#	with probability 1-3*p. Channels are cached by p, so that repeated sweeps over the
+#	same probabilities do not rebuild them.
+#
+# Inputs:
+#	p - probability of each non-trivial Pauli gate
+#
+# Outputs:
+#	error - the channel, as a QuantumError
+#
+# Requirements:
+#	lru_cache from functools
+#	pauli_error from qiskit_aer.noise
+
+@lru_cache(maxsize=None)
+def _random_Pauli_error(p):
+	return pauli_error([('X',p), ('Y',p), ('Z',p), ('I', 1 - 3*p)])
+
+
+# Propagate Pauli Frames
+#
+# Description:
+#	Tracks Pauli errors through the given circuit, each as a Pauli frame: the Pauli that
+#	relates the noisy state to the state without errors. Clifford gates conjugate each
+#	frame. A measurement's outcome is flipped (compared with the outcome without errors)
+#	when the frame has an X part on the measured qubit, and if-blocks (with or without an
+#	else-block) and switches (with or without a default case) then pick their bodies
+#	based on the flipped outcomes (through conditions on bits, registers, or classical
+#	expressions of them), multiplying the frame by the Pauli gates of the body that is
+#	picked (and by those of the body that is picked without errors). This assumes that,
+#	without errors, every measurement outcome is 0 (as for syndrome measurements) and
+#	that the bodies consist of Pauli gates (so they may not contain further if-blocks or
+#	switches). Phases of the frames are ignored, as they do not affect measurements.
+#
+# Inputs:
+#	qc - the circuit of Clifford gates, measurements, and if-blocks or switches
+#	frames - the frames at the start of the circuit, as an array with one row per frame,
+#		holding the X part for each qubit of qc followed by the Z part for each qubit
+#
+# Outputs:
+#	frames - the frames at the end of the circuit, in the same form
+#
+# Requirements:
+#	QuantumCircuit from qiskit.circuit
+#	CASE_DEFAULT from qiskit.circuit
+#	expr from qiskit.circuit.classical
+#	Pauli from qiskit.quantum_info
+#	numpy as np
+#	_evaluate_classical_expression
+#	_apply_Clifford_to_Pauli_frames
+
+def _propagate_Pauli_frames(qc, frames):
+	num_qubits = qc.num_qubits
+	flips = {} # keys = measured clbits, values = whether each frame flips the outcome
+	clifford_qc = QuantumCircuit(qc.qubits) # Clifford gates not yet applied to the frames
+
+	for instruction in qc.data:
+		operation = instruction.operation
+		if operation.name == 'barrier':
+			continue
+		elif operation.name not in ['measure', 'if_else', 'switch_case']:
+			clifford_qc.append(instruction)
+			continue
+
+		frames = _apply_Clifford_to_Pauli_frames(clifford_qc, frames)
+		clifford_qc = QuantumCircuit(qc.qubits)
+
+		if operation.name == 'measure':
+			qubit_index = qc.find_bit(instruction.qubits[0]).index
+			flips[instruction.clbits[0]] = frames[:, qubit_index].copy()
+			continue
+
+		# evaluate the condition or target as a classical expression, for the outcomes of
+		# each frame and for the outcomes without errors (all 0)
+		if operation.name == 'if_else':
+			condition = operation.condition
+			if isinstance(condition, tuple):
+				condition = expr.lift_legacy_condition(condition)
+		else:
+			condition = operation.target
+			if not isinstance(condition, expr.Expr):
+				condition = expr.lift(condition)
+		values = _evaluate_classical_expression(condition, flips)
+		value_without_errors = _evaluate_classical_expression(
+			condition, dict.fromkeys(flips, np.uint8(0))
+		)
+
+		# list each body along with whether each frame picks it, and whether it is picked
+		# without errors
+		cases = []
+		if operation.name == 'if_else':
+			cases.append((values, value_without_errors, operation.blocks[0]))
+			if len(operation.blocks) > 1 and operation.blocks[1] is not None:
+				cases.append((~values, not value_without_errors, operation.blocks[1]))
+		else:
+			listed_values = []
+			for case_values, body in operation.cases_specifier():
+				if CASE_DEFAULT in case_values:
+					picked = ~np.isin(values, listed_values)
+					cases.append((picked, value_without_errors not in listed_values, body))
+				else:
+					case_values = [int(case_value) for case_value in case_values]
+					listed_values += case_values
+					cases.append(
+						(np.isin(values, case_values), value_without_errors in case_values, body)
+					)
+
+		qubit_indices = np.array([qc.find_bit(qubit).index for qubit in instruction.qubits])
+		for picked, picked_without_errors, body in cases:
+			# get the body's Pauli, as a row in the same form as the frames
+			body_qc = QuantumCircuit(body.qubits)
+			for body_instruction in body.data:
+				body_qc.append(body_instruction)
+			body_Pauli = Pauli(body_qc)
+			body_row = np.zeros(2*num_qubits, dtype=np.uint8)
+			body_row[qubit_indices] = body_Pauli.x
+			body_row[num_qubits + qubit_indices] = body_Pauli.z
+
+			frames[picked] ^= body_row
+			if picked_without_errors:
+				frames ^= body_row
+
+	return _apply_Clifford_to_Pauli_frames(clifford_qc, frames)
+
+
+# Evaluate Classical Expression
+#
+# Description:
+#	Evaluates a classical expression (e.g. the condition of an if-block, or the target of
+#	a switch) on the given measurement outcomes. Supports bits and registers, constants,
+#	casts, and the logical, bitwise, and comparison operations.
+#
+# Inputs:
+#	expression - the classical expression
+#	outcomes - a dictionary with keys = clbits and values = their outcomes, each a single
+#		value or an array of values (e.g. one per frame)
+#
+# Outputs:
+#	value - the value of the expression (as a bool or integer), or an array of values
+#
+# Requirements:
+#	Clbit, ClassicalRegister from qiskit.circuit
+#	expr, types from qiskit.circuit.classical
+#	numpy as np
+
+def _evaluate_classical_expression(expression, outcomes):
+	if isinstance(expression, expr.Var) and isinstance(expression.var, Clbit):
+		return outcomes[expression.var] != 0
+	elif isinstance(expression, expr.Var) and isinstance(expression.var, ClassicalRegister):
+		return sum(
+			outcomes[bit].astype(np.int64) << j for j, bit in enumerate(expression.var)
+		)
+	elif isinstance(expression, expr.Value):
+		return expression.value
+	elif isinstance(expression, expr.Cast):
+		value = _evaluate_classical_expression(expression.operand, outcomes)
+		if isinstance(expression.type, types.Bool):
+			return value != 0
+		return np.asarray(value).astype(np.int64)
+	elif isinstance(expression, expr.Unary) and expression.op != expr.Unary.Op.NEGATE:
+		# logical or bitwise not
+		value = _evaluate_classical_expression(expression.operand, outcomes)
+		if isinstance(expression.type, types.Bool):
+			return np.logical_not(value)
+		return ~value & ((1 << expression.type.width) - 1)
+	elif isinstance(expression, expr.Binary) and expression.op in _binary_operations:
+		return _binary_operations[expression.op](
+			_evaluate_classical_expression(expression.left, outcomes),
+			_evaluate_classical_expression(expression.right, outcomes)
+		)
+	raise ValueError('unsupported classical expression: ' + str(expression))
+
+# the binary operations supported by _evaluate_classical_expression
+_binary_operations = {
+	expr.Binary.Op.BIT_AND: np.bitwise_and,
+	expr.Binary.Op.BIT_OR: np.bitwise_or,
+	expr.Binary.Op.BIT_XOR: np.bitwise_xor,
+	expr.Binary.Op.LOGIC_AND: np.logical_and,
+	expr.Binary.Op.LOGIC_OR: np.logical_or,
+	expr.Binary.Op.EQUAL: np.equal,
+	expr.Binary.Op.NOT_EQUAL: np.not_equal,
+	expr.Binary.Op.LESS: np.less,
+	expr.Binary.Op.LESS_EQUAL: np.less_equal,
+	expr.Binary.Op.GREATER: np.greater,
+	expr.Binary.Op.GREATER_EQUAL: np.greater_equal,
+}
+
+
+# Apply Clifford to Pauli Frames
+#
+# Description:
+#	Conjugates Pauli frames (ignoring phases) by the Clifford circuit. The rows of the
+#	circuit's tableau are the images of the X and Z on each qubit, so the image of a frame
+#	is the sum (mod 2) of the rows for its X and Z parts.
+#
+# Inputs:
+#	qc - the circuit of Clifford gates
+#	frames - the frames, in the form used by _propagate_Pauli_frames
+#
+# Outputs:
+#	frames - the conjugated frames
+#
+# Requirements:
+#	Clifford from qiskit.quantum_info
+#	numpy as np
+
+def _apply_Clifford_to_Pauli_frames(qc, frames):
+	if len(qc.data) == 0:
+		return frames
+	tableau = Clifford(qc).tableau[:, :-1].astype(np.uint8)
+	return (frames @ tableau) % 2